@@ -4,11 +4,12 @@ MTC Assistant - Broadcast Module
 ระบบประกาศ Push สำหรับส่งข้อความไปหาผู้ใช้ทั้งหมด
 """
 
+from datetime import datetime as _DT, timedelta as _TD
+
 from linebot.v3.messaging import (
-    ApiClient, MessagingApi, Configuration,
-    BroadcastRequest, TextMessage, PushMessageRequest
+    MessagingApi, BroadcastRequest, TextMessage, PushMessageRequest
 )
-from config import logger, ACCESS_TOKEN
+from config import logger, ACCESS_TOKEN, LOCAL_TZ
 from firebase_admin import firestore
 
 # Global variables
@@ -24,11 +25,10 @@ def set_database(database):
     global db
     db = database
 
-def set_line_api(config: Configuration):
-    """Initialize LINE Messaging API"""
+def set_line_api(api: MessagingApi):
+    """Set LINE Messaging API client (shared with handlers)"""
     global line_api
-    if config:
-        line_api = MessagingApi(ApiClient(config))
+    line_api = api
 
 # ============================================================================
 # USER TRACKING
@@ -51,10 +51,10 @@ def track_user(user_id: str, display_name: str = "Unknown"):
             'last_seen': firestore.SERVER_TIMESTAMP,
             'is_active': True
         }, merge=True)
-        logger.debug(f"User tracked: {user_id}")
+        logger.debug("User tracked: %s", user_id)
         return True
     except Exception as e:
-        logger.error(f"Error tracking user: {e}")
+        logger.error("Error tracking user: %s", e)
         return False
 
 def get_all_users():
@@ -66,10 +66,10 @@ def get_all_users():
     try:
         users_ref = db.collection('users').where('is_active', '==', True).stream()
         user_ids = [user.to_dict().get('user_id') for user in users_ref]
-        logger.info(f"Retrieved {len(user_ids)} active users")
+        logger.info("Retrieved %s active users", len(user_ids))
         return user_ids
     except Exception as e:
-        logger.error(f"Error getting users: {e}")
+        logger.error("Error getting users: %s", e)
         return []
 
 def get_user_count() -> int:
@@ -82,7 +82,7 @@ def get_user_count() -> int:
         count = sum(1 for _ in users_ref)
         return count
     except Exception as e:
-        logger.error(f"Error counting users: {e}")
+        logger.error("Error counting users: %s", e)
         return 0
 
 # ============================================================================
@@ -127,10 +127,10 @@ def broadcast_message(message_text: str) -> dict:
                 )
             )
             sent_count += 1
-            logger.debug(f"Message sent to {user_id}")
+            logger.debug("Message sent to %s", user_id)
         except Exception as e:
             failed_count += 1
-            logger.error(f"Failed to send to {user_id}: {e}")
+            logger.error("Failed to send to %s: %s", user_id, e)
     
     result_message = f"✅ ส่งสำเร็จ: {sent_count} คน"
     if failed_count > 0:
@@ -154,7 +154,7 @@ def broadcast_homework_reminder():
     
     try:
         # ดึงการบ้านที่ต้องส่งพรุ่งนี้
-        tomorrow = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        tomorrow = (_DT.now(LOCAL_TZ) + _TD(days=1)).strftime("%Y-%m-%d")
         
         homeworks = db.collection('homeworks').where('due_date', '==', tomorrow).stream()
         hw_list = []
@@ -172,9 +172,9 @@ def broadcast_homework_reminder():
             )
             
             result = broadcast_message(message)
-            logger.info(f"Homework reminder sent: {result}")
+            logger.info("Homework reminder sent: %s", result)
     except Exception as e:
-        logger.error(f"Error sending homework reminder: {e}")
+        logger.error("Error sending homework reminder: %s", e)
 
 # ============================================================================
 # BROADCAST TEMPLATES
@@ -210,9 +210,9 @@ def save_broadcast_history(admin_id: str, message: str, result: dict):
             'timestamp': firestore.SERVER_TIMESTAMP,
             'success': result.get('success', False)
         })
-        logger.info(f"Broadcast history saved by {admin_id}")
+        logger.info("Broadcast history saved by %s", admin_id)
     except Exception as e:
-        logger.error(f"Error saving broadcast history: {e}")
+        logger.error("Error saving broadcast history: %s", e)
 
 def get_broadcast_stats() -> str:
     """ดูสถิติการส่ง broadcast"""
@@ -257,7 +257,7 @@ def get_broadcast_stats() -> str:
         
         return stats
     except Exception as e:
-        logger.error(f"Error getting broadcast stats: {e}")
+        logger.error("Error getting broadcast stats: %s", e)
         return f"❌ เกิดข้อผิดพลาด: {str(e)}"
 
 # ============================================================================
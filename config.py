@@ -45,12 +45,38 @@ FLASK_DEBUG = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
 # Gemini Model Configuration
 GEMINI_MODEL_NAME = "gemini-3-flash-preview"
 
+# Seconds between idle pings that keep the LINE API connection warm (0 = off).
+# Only useful on hosts that stay up between bursts of traffic.
+LINE_KEEPALIVE_INTERVAL = int(os.environ.get("LINE_KEEPALIVE_INTERVAL", 0))
+
+# Background threads that answer AI questions off the webhook thread
+AI_WORKER_THREADS = int(os.environ.get("AI_WORKER_THREADS", 8))
+
+# Gemini response cache (identical prompts reuse the previous answer)
+GEMINI_CACHE_ENABLED = os.environ.get("GEMINI_CACHE_ENABLED", "true").lower() == "true"
+GEMINI_CACHE_SIZE = int(os.environ.get("GEMINI_CACHE_SIZE", 512))
+GEMINI_CACHE_TTL = int(os.environ.get("GEMINI_CACHE_TTL", 3600))  # seconds
+if GEMINI_CACHE_TTL <= 0 or GEMINI_CACHE_SIZE <= 0:
+    # 0 (or negative) means "don't cache" rather than a division by zero later
+    GEMINI_CACHE_ENABLED = False
+
 # ============================================================================
 # RATE LIMITING CONFIGURATION
 # ============================================================================
 RATE_LIMIT_MAX = int(os.environ.get("RATE_LIMIT_MAX", 6))
 RATE_LIMIT_WINDOW = int(os.environ.get("RATE_LIMIT_WINDOW", 60))
 
+# Rate limits live in process memory; with several gunicorn workers
+# (WEB_CONCURRENCY) each worker would grant its own RATE_LIMIT_MAX
+try:
+    if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        logger.warning(
+            "WEB_CONCURRENCY > 1: rate limits are per process and will be "
+            "multiplied by the worker count. Run one worker with --threads instead."
+        )
+except ValueError:
+    pass
+
 # ============================================================================
 # ADMIN CONFIGURATION
 # ============================================================================
@@ -66,7 +92,23 @@ if not ADMIN_USER_IDS or ADMIN_USER_IDS == ['']:
 # CONSTANTS
 # ============================================================================
 LINE_MAX_TEXT = 5000
+LINE_MAX_MESSAGES = 5  # จำนวนข้อความสูงสุดต่อการ reply หนึ่งครั้ง
 LINE_SAFE_TRUNCATE = 4800
+# ความยาวคำตอบของ Gemini คุมด้วย system instruction (SDK google-generativeai
+# ตั้ง thinking budget ไม่ได้) ให้พอดีข้อความ LINE โดยเผื่อที่ไว้เพราะโมเดลมักตอบเกิน
+GEMINI_ANSWER_CHAR_LIMIT = LINE_SAFE_TRUNCATE // 2
+GEMINI_SYSTEM_INSTRUCTION = (
+    f"ตอบให้กระชับ ความยาวไม่เกิน {GEMINI_ANSWER_CHAR_LIMIT} ตัวอักษร "
+    "ถ้าเนื้อหายาวให้สรุปเฉพาะใจความสำคัญ"
+)
+# max_output_tokens เป็นเพดานรวมของ token ที่ใช้ "คิด" (GEMINI_MODEL_NAME เป็น
+# thinking model) กับคำตอบ - ไม่ได้คุมความยาวคำตอบ แค่กันไม่ให้คิดยาวไม่รู้จบ
+# คำตอบที่ชนเพดาน (finish_reason MAX_TOKENS) จะไม่ถูก cache
+GEMINI_THINKING_TOKEN_ALLOWANCE = int(os.environ.get("GEMINI_THINKING_TOKEN_ALLOWANCE", 8192))
+GEMINI_MAX_OUTPUT_TOKENS = int(os.environ.get(
+    "GEMINI_MAX_OUTPUT_TOKENS", GEMINI_ANSWER_CHAR_LIMIT // 3 + GEMINI_THINKING_TOKEN_ALLOWANCE
+))
+AI_MIN_PROMPT_LENGTH = 2  # ข้อความสั้นกว่านี้ไม่ส่งไปหา AI
 LOCAL_TZ = ZoneInfo("Asia/Bangkok")
 
 # ============================================================================
@@ -93,7 +135,9 @@ MESSAGES = {
     "AI_NO_RESPONSE": "ขออภัยครับ ระบบ AI ตอบไม่ได้ในขณะนี้ ลองใหม่อีกครั้ง",
     "AI_ERROR": "ขออภัยครับ ตอนนี้ผมมีปัญหาในการเชื่อมต่อกับ AI ลองใหม่อีกครั้งนะ",
     "RATE_LIMITED": "คุณส่งข้อความเร็วจนเกินไป ลองช้าลงอีกนิดนะครับ",
+    "BANNED": "⛔ คุณถูกระงับชั่วคราวเนื่องจากส่งข้อความมากเกินไป\nกรุณารออีก {seconds} วินาที",
     "INVALID_MESSAGE": "ขออภัยครับ ผมรับข้อความประเภทนี้ไม่ได้นะ ลองพิมพ์ข้อความ",
+    "MESSAGE_TOO_SHORT": "พิมพ์คำสั่งหรือข้อความมาได้เลยครับ",
     "NO_CLASS_TODAY": "วันนี้วันหยุดไม่ใช่วันเรียน กลับไปนอนไป๊ 🎉",
     "NO_CLASS_LEFT": "วันนี้ไม่มีคาบเรียนแล้วครับ กลับบ้านได้เลยครับ 🏠",
     "ACTION_ERROR": "ขออภัยครับ เกิดข้อผิดพลาดขณะประมวลผลคำสั่งของคุณ",
@@ -178,4 +222,4 @@ def validate_config():
     if not GEMINI_API_KEY:
         logger.info("GEMINI_API_KEY not set; AI features disabled.")
     
-    logger.info(f"Configuration loaded: PORT={PORT}, DEBUG={FLASK_DEBUG}")
+    logger.info("Configuration loaded: PORT=%s, DEBUG=%s", PORT, FLASK_DEBUG)
@@ -4,12 +4,15 @@ MTC Assistant - Features Module
 Contains all feature functions: schedule, homework, music, AI, etc.
 """
 
-import datetime
-import math
+import bisect
+import functools
 import re
+import threading
+import time
 import urllib.parse
-from typing import Optional
-import google.generativeai as genai
+from collections import OrderedDict
+from datetime import datetime as _DT, date as _DATE, time as _TIME
+from typing import List, Optional, Tuple
 
 from linebot.v3.messaging import TextMessage, ImageMessage
 
@@ -17,7 +20,8 @@ from linebot.v3.messaging import TextMessage, ImageMessage
 from config import (
     logger, LOCAL_TZ, SCHEDULE, EXAM_DATES, MESSAGES,
     WORKSHEET_LINK, SCHOOL_LINK, TIMETABLE_IMG, GRADE_LINK,
-    ABSENCE_LINK, Bio_LINK, Physic_LINK, LINE_SAFE_TRUNCATE
+    ABSENCE_LINK, Bio_LINK, Physic_LINK, LINE_SAFE_TRUNCATE,
+    GEMINI_CACHE_SIZE, GEMINI_CACHE_TTL, GEMINI_CACHE_ENABLED
 )
 
 # Global variables (will be set by main.py)
@@ -46,11 +50,11 @@ def add_homework_to_db(subject: str, detail: str, due_date: str = "ไม่ร
             'detail': detail,
             'due_date': due_date,
             'timestamp': firestore.SERVER_TIMESTAMP,
-            'created_at': datetime.datetime.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+            'created_at': _DT.now(tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
         })
         return f"✅ เพิ่มการบ้านวิชา '{subject}' สำเร็จแล้วครับ!"
     except Exception as e:
-        logger.error(f"DB Add Error: {e}")
+        logger.error("DB Add Error: %s", e)
         return "❌ เกิดข้อผิดพลาดในการเพิ่มการบ้าน"
 
 def get_homeworks_from_db() -> str:
@@ -76,7 +80,7 @@ def get_homeworks_from_db() -> str:
         
         return "📋 *รายการการบ้านปัจจุบัน*\n\n" + "\n" + "-" * 30 + "\n".join(hw_list)
     except Exception as e:
-        logger.error(f"DB Get Error: {e}")
+        logger.error("DB Get Error: %s", e)
         return "❌ เกิดข้อผิดพลาดในการดึงข้อมูลการบ้าน"
 
 def clear_homework_db() -> str:
@@ -93,180 +97,221 @@ def clear_homework_db() -> str:
         
         return f"🗑️ ลบการบ้านทั้งหมดแล้ว ({count} รายการ)"
     except Exception as e:
-        logger.error(f"DB Clear Error: {e}")
+        logger.error("DB Clear Error: %s", e)
         return "❌ เกิดข้อผิดพลาดในการลบข้อมูล"
 
 # ============================================================================
 # BASIC COMMAND FUNCTIONS
 # ============================================================================
 
+# ข้อความตอบกลับที่ไม่เปลี่ยนตาม request สร้างครั้งเดียวตอน import แล้วใช้ซ้ำ
+_HELP_TEXT = (
+    '📖 รายการคำสั่งทั้งหมด\n\n'
+    '📋 คำสั่งพื้นฐาน\n'
+    '- งาน / การบ้าน = ดูใบงาน\n'
+    '- เว็บโรงเรียน = ลิงก์เว็บโรงเรียน\n'
+    '- ตารางเรียน = ดูตารางเรียน\n'
+    '- เกรด = เช็คเกรด\n'
+    '- คาบต่อไป = ดูว่าเรียนอะไรต่อ\n'
+    '- อีกกี่นาที = เช็คเวลาเหลือก่อนคาบถัดไป\n'
+    '- ลา = แบบฟอร์มลา\n'
+    '- สอบ = นับถอยหลังวันสอบ\n\n'
+    '🧪 คำสั่งเฉลย\n'
+    '- ชีวะ = เฉลยชีววิทยา\n'
+    '- ฟิสิกส์ = เฉลยฟิสิกส์\n\n'
+    '🎵 ความบันเทิง\n'
+    '- เปิดเพลง [ชื่อเพลง] = หาเพลงจาก YouTube\n\n'
+    '💾 คำสั่งการบ้าน\n'
+    '- สั่งการบ้าน | วิชา | รายละเอียด | วันส่ง\n'
+    '  ตัวอย่าง: สั่งการบ้าน | ฟิสิกส์ | ทำแบบฝึกหัด 4.1 | วันศุกร์\n'
+    '- การบ้าน / ดูการบ้าน = ดูการบ้านทั้งหมด\n'
+    '- ลบการบ้านทั้งหมด = ล้างข้อมูล\n\n'
+    '🤖 AI\n'
+    '- พิมพ์ข้อความอื่นๆ = ตอบด้วย AI\n\n'
+)
+
+_WORKSHEET_MESSAGE = TextMessage(text=f"📝 ตารางงานอยู่นี่ครับ {WORKSHEET_LINK}")
+_SCHOOL_LINK_MESSAGE = TextMessage(text=f"🏫 เว็บไซต์โรงเรียนครับ {SCHOOL_LINK}")
+_TIMETABLE_IMAGE_MESSAGE = ImageMessage(original_content_url=TIMETABLE_IMG, preview_image_url=TIMETABLE_IMG)
+_GRADE_LINK_MESSAGE = TextMessage(text=f"📊 เช็คเกรดได้ที่นี่ครับ {GRADE_LINK}")
+_ABSENCE_FORM_MESSAGE = TextMessage(text=f"📝 ลิงก์แจ้งลาครับ {ABSENCE_LINK}")
+_BIO_LINK_MESSAGE = TextMessage(text=f"🧬 เฉลยชีววิทยาครับ {Bio_LINK}")
+_PHYSIC_LINK_MESSAGE = TextMessage(text=f"⚛️ เฉลยฟิสิกส์ครับ {Physic_LINK}")
+_HELP_MESSAGE = TextMessage(text=_HELP_TEXT)
+
 def get_worksheet_message(user_message: str = "") -> TextMessage:
     """ส่งลิงก์ใบงาน"""
-    return TextMessage(text=f"📝 ตารางงานอยู่นี่ครับ {WORKSHEET_LINK}")
+    return _WORKSHEET_MESSAGE
 
 def get_school_link_message(user_message: str = "") -> TextMessage:
     """ส่งลิงก์เว็บโรงเรียน"""
-    return TextMessage(text=f"🏫 เว็บไซต์โรงเรียนครับ {SCHOOL_LINK}")
+    return _SCHOOL_LINK_MESSAGE
 
 def get_timetable_image_message(user_message: str = "") -> ImageMessage:
     """ส่งรูปตารางเรียน"""
-    return ImageMessage(original_content_url=TIMETABLE_IMG, preview_image_url=TIMETABLE_IMG)
+    return _TIMETABLE_IMAGE_MESSAGE
 
 def get_grade_link_message(user_message: str = "") -> TextMessage:
     """ส่งลิงก์เช็คเกรด"""
-    return TextMessage(text=f"📊 เช็คเกรดได้ที่นี่ครับ {GRADE_LINK}")
+    return _GRADE_LINK_MESSAGE
 
 def get_absence_form_message(user_message: str = "") -> TextMessage:
     """ส่งลิงก์แบบฟอร์มลา"""
-    return TextMessage(text=f"📝 ลิงก์แจ้งลาครับ {ABSENCE_LINK}")
+    return _ABSENCE_FORM_MESSAGE
 
 def get_bio_link_message(user_message: str = "") -> TextMessage:
     """ส่งลิงก์เฉลยชีวะ"""
-    return TextMessage(text=f"🧬 เฉลยชีววิทยาครับ {Bio_LINK}")
+    return _BIO_LINK_MESSAGE
 
 def get_physic_link_message(user_message: str = "") -> TextMessage:
     """ส่งลิงก์เฉลยฟิสิกส์"""
-    return TextMessage(text=f"⚛️ เฉลยฟิสิกส์ครับ {Physic_LINK}")
+    return _PHYSIC_LINK_MESSAGE
 
 def get_help_message(user_message: str = "") -> TextMessage:
     """แสดงคำสั่งทั้งหมด"""
-    help_text = (
-        '📖 รายการคำสั่งทั้งหมด\n\n'
-        '📋 คำสั่งพื้นฐาน\n'
-        '- งาน / การบ้าน = ดูใบงาน\n'
-        '- เว็บโรงเรียน = ลิงก์เว็บโรงเรียน\n'
-        '- ตารางเรียน = ดูตารางเรียน\n'
-        '- เกรด = เช็คเกรด\n'
-        '- คาบต่อไป = ดูว่าเรียนอะไรต่อ\n'
-        '- อีกกี่นาที = เช็คเวลาเหลือก่อนคาบถัดไป\n'
-        '- ลา = แบบฟอร์มลา\n'
-        '- สอบ = นับถอยหลังวันสอบ\n\n'
-        '🧪 คำสั่งเฉลย\n'
-        '- ชีวะ = เฉลยชีววิทยา\n'
-        '- ฟิสิกส์ = เฉลยฟิสิกส์\n\n'
-        '🎵 ความบันเทิง\n'
-        '- เปิดเพลง [ชื่อเพลง] = หาเพลงจาก YouTube\n\n'
-        '💾 คำสั่งการบ้าน\n'
-        '- สั่งการบ้าน | วิชา | รายละเอียด | วันส่ง\n'
-        '  ตัวอย่าง: สั่งการบ้าน | ฟิสิกส์ | ทำแบบฝึกหัด 4.1 | วันศุกร์\n'
-        '- การบ้าน / ดูการบ้าน = ดูการบ้านทั้งหมด\n'
-        '- ลบการบ้านทั้งหมด = ล้างข้อมูล\n\n'
-        '🤖 AI\n'
-        '- พิมพ์ข้อความอื่นๆ = ตอบด้วย AI\n\n'
-    )
-    return TextMessage(text=help_text)
+    return _HELP_MESSAGE
 
 # ============================================================================
 # SCHEDULE FUNCTIONS
 # ============================================================================
 
+# SCHEDULE ถูกแปลงเป็น Structure-of-Arrays ครั้งเดียวตอน import:
+# แต่ละวันมี tuple ขนานกัน (เวลาเริ่ม, เวลาจบ, วิชา, ห้อง) เรียงตามเวลา
+# ทำให้ไม่ต้อง strptime ซ้ำทุก request และหาคาบด้วย bisect ได้
+def _parse_hm(hm: str) -> _TIME:
+    """แปลง "HH:MM" เป็น datetime.time (เร็วกว่า strptime มาก)"""
+    hour, minute = hm.split(":")
+    return _TIME(int(hour), int(minute))
+
+_SCHEDULE_STARTS = {day: tuple(_parse_hm(p["start"]) for p in periods) for day, periods in SCHEDULE.items()}
+_SCHEDULE_ENDS = {day: tuple(_parse_hm(p["end"]) for p in periods) for day, periods in SCHEDULE.items()}
+_SCHEDULE_SUBJECTS = {day: tuple(p["subject"] for p in periods) for day, periods in SCHEDULE.items()}
+_SCHEDULE_ROOMS = {day: tuple(p["room"] for p in periods) for day, periods in SCHEDULE.items()}
+
+def _next_different_subject(subjects: Tuple[str, ...]) -> Tuple[Optional[int], ...]:
+    """สำหรับแต่ละคาบ หา index ของคาบถัดไปที่วิชาต่างออกไป (None ถ้าไม่มี)"""
+    result: List[Optional[int]] = [None] * len(subjects)
+    # ไล่จากคาบสุดท้าย: คาบวิชาเดียวกันติดกันใช้คำตอบเดียวกัน
+    for idx in range(len(subjects) - 2, -1, -1):
+        result[idx] = idx + 1 if subjects[idx + 1] != subjects[idx] else result[idx + 1]
+    return tuple(result)
+
+_SCHEDULE_NEXT_SUBJECT = {day: _next_different_subject(subjects) for day, subjects in _SCHEDULE_SUBJECTS.items()}
+
+def _format_hm(t: _TIME) -> str:
+    """แปลงเวลาเป็นข้อความ HH:MM"""
+    return f"{t.hour:02d}:{t.minute:02d}"
+
+def _locate_period(day_idx: int, current_time: _TIME) -> Tuple[Optional[int], int]:
+    """
+    หาคาบปัจจุบันด้วย bisect (O(log n))
+    
+    Returns:
+        (index ของคาบที่กำลังเรียน หรือ None, index ของคาบแรกที่ยังไม่เริ่ม)
+    """
+    # idx = คาบแรกที่ยังไม่เริ่ม; คาบ idx-1 คือคาบล่าสุดที่เริ่มไปแล้ว
+    idx = bisect.bisect_right(_SCHEDULE_STARTS[day_idx], current_time)
+    if idx > 0 and current_time < _SCHEDULE_ENDS[day_idx][idx - 1]:
+        return idx - 1, idx
+    return None, idx
+
 def get_next_class_message(user_message: str = "") -> TextMessage:
     """แสดงคาบเรียนถัดไป"""
-    now = datetime.datetime.now(LOCAL_TZ)
+    now = _DT.now(LOCAL_TZ)
     day_idx = now.weekday()
     
     if day_idx not in SCHEDULE:
         return TextMessage(text=MESSAGES["NO_CLASS_TODAY"])
     
-    current_time = now.time()
-    periods = SCHEDULE[day_idx]
+    starts = _SCHEDULE_STARTS[day_idx]
+    ends = _SCHEDULE_ENDS[day_idx]
+    current_index, idx = _locate_period(day_idx, now.time())
     
-    for period in periods:
-        start_time = datetime.datetime.strptime(period["start"], "%H:%M").time()
-        end_time = datetime.datetime.strptime(period["end"], "%H:%M").time()
-        
-        # ถ้ายังไม่ถึงเวลาเริ่มคาบนี้
-        if current_time < start_time:
-            return TextMessage(
-                text=f"🔜 คาบต่อไป : {period['subject']}\n"
-                     f"📍 ห้อง : {period['room']}\n"
-                     f"⏰ เวลา : {period['start']} - {period['end']}"
-            )
-        
-        # ถ้ากำลังอยู่ในคาบนี้
-        if start_time <= current_time < end_time:
-            return TextMessage(
-                text=f"⏳ กำลังเรียน : {period['subject']}\n"
-                     f"📍 ห้อง : {period['room']}\n"
-                     f"⏰ จนถึง : {period['end']}"
-            )
+    # ถ้ากำลังอยู่ในคาบนี้
+    if current_index is not None:
+        return TextMessage(
+            text=f"⏳ กำลังเรียน : {_SCHEDULE_SUBJECTS[day_idx][current_index]}\n"
+                 f"📍 ห้อง : {_SCHEDULE_ROOMS[day_idx][current_index]}\n"
+                 f"⏰ จนถึง : {_format_hm(ends[current_index])}"
+        )
+    
+    # ถ้ายังไม่ถึงเวลาเริ่มคาบถัดไป
+    if idx < len(starts):
+        return TextMessage(
+            text=f"🔜 คาบต่อไป : {_SCHEDULE_SUBJECTS[day_idx][idx]}\n"
+                 f"📍 ห้อง : {_SCHEDULE_ROOMS[day_idx][idx]}\n"
+                 f"⏰ เวลา : {_format_hm(starts[idx])} - {_format_hm(ends[idx])}"
+        )
     
     return TextMessage(text=MESSAGES["NO_CLASS_LEFT"])
 
 def get_time_until_next_class_message(user_message: str = "") -> TextMessage:
     """คำนวณเวลาเหลือก่อนคาบถัดไป"""
-    now = datetime.datetime.now(LOCAL_TZ)
+    now = _DT.now(LOCAL_TZ)
     day_idx = now.weekday()
     
     if day_idx not in SCHEDULE:
         return TextMessage(text=MESSAGES["NO_CLASS_TODAY"])
     
-    current_time = now.time()
-    periods = SCHEDULE[day_idx]
+    starts = _SCHEDULE_STARTS[day_idx]
+    subjects = _SCHEDULE_SUBJECTS[day_idx]
     
     # หาว่าตอนนี้อยู่ในคาบไหน
-    current_index = None
-    for idx, period in enumerate(periods):
-        start_t = datetime.datetime.strptime(period["start"], "%H:%M").time()
-        end_t = datetime.datetime.strptime(period["end"], "%H:%M").time()
-        if start_t <= current_time < end_t:
-            current_index = idx
-            break
+    current_index, next_index = _locate_period(day_idx, now.time())
     
-    target = None
     if current_index is None:
-        # ไม่ได้อยู่ในคาบเรียน หาคาบถัดไป
-        for period in periods:
-            start_t = datetime.datetime.strptime(period["start"], "%H:%M").time()
-            if current_time < start_t:
-                target = period
-                break
-        
-        if target is None:
+        # ไม่ได้อยู่ในคาบเรียน คาบถัดไปคือคาบแรกที่ยังไม่เริ่ม
+        if next_index >= len(starts):
             return TextMessage(text=MESSAGES["NO_CLASS_LEFT"])
+        target = next_index
     else:
-        # อยู่ในคาบเรียน หาคาบถัดไปที่วิชาต่างจากปัจจุบัน
-        current_subject = periods[current_index]["subject"]
-        for idx in range(current_index + 1, len(periods)):
-            if periods[idx]["subject"] != current_subject:
-                target = periods[idx]
-                break
-        
+        # อยู่ในคาบเรียน คาบถัดไปที่วิชาต่างจากปัจจุบัน (คำนวณไว้ตอน import)
+        target = _SCHEDULE_NEXT_SUBJECT[day_idx][current_index]
         if target is None:
             return TextMessage(text="วันนี้ไม่มีคาบเรียนที่ต่างจากคาบปัจจุบันอีกแล้วครับ")
     
-    # คำนวณเวลาเหลือ
-    target_start_time = datetime.datetime.strptime(target["start"], "%H:%M").time()
-    target_dt = datetime.datetime.combine(now.date(), target_start_time).replace(tzinfo=LOCAL_TZ)
-    delta_seconds = (target_dt - now).total_seconds()
-    minutes_left = max(0, math.ceil(delta_seconds / 60))
+    # คำนวณเวลาเหลือด้วยวินาทีแบบจำนวนเต็ม (คาบถัดไปอยู่ในวันเดียวกันเสมอ)
+    start = starts[target]
+    delta_seconds = (
+        start.hour * 3600 + start.minute * 60
+        - (now.hour * 3600 + now.minute * 60 + now.second)
+    )
+    # ปัดขึ้นเป็นนาที; เศษไมโครวินาทีของ now ไม่เปลี่ยนผลลัพธ์
+    minutes_left = max(0, (delta_seconds + 59) // 60)
     
     minutes_text = "น้อยกว่า 1 นาที" if minutes_left == 0 else f"{minutes_left} นาที"
     
     return TextMessage(
         text=f"⏰ เหลือเวลาอีก {minutes_text}\n"
-             f"🔜 คาบถัดไป : {target['subject']}\n"
-             f"📍 ห้อง : {target['room']}"
+             f"🔜 คาบถัดไป : {subjects[target]}\n"
+             f"📍 ห้อง : {_SCHEDULE_ROOMS[day_idx][target]}"
     )
 
 # ============================================================================
 # EXAM COUNTDOWN
 # ============================================================================
 
-def get_exam_countdown_message(user_message: str = "") -> TextMessage:
-    """นับถอยหลังวันสอบ (Multi-date support)"""
-    now = datetime.datetime.now(LOCAL_TZ).date()
+# ข้อมูลวันสอบคงที่ตลอดอายุ process จึงคำนวณ ordinal และข้อความวันที่ไว้ครั้งเดียว
+# exam_name -> (sorted tuple of date ordinals, "dd/mm, dd/mm, ...")
+_EXAM_META = {
+    exam_name: (
+        tuple(sorted(d.toordinal() for d in dates)),
+        ", ".join(d.strftime("%d/%m") for d in dates),
+    )
+    for exam_name, dates in EXAM_DATES.items()
+}
+
+@functools.lru_cache(maxsize=32)
+def _exam_countdown_text(today_ord: int, exam_names: Tuple[str, ...]) -> str:
+    """ข้อความนับถอยหลังสอบของวันที่กำหนด (เปลี่ยนแค่วันละครั้ง จึง cache ตามวัน)"""
     msg_list = ["⏳ *นับถอยหลังสอบ*\n"]
-    found = False
-    
-    for exam_name, dates in EXAM_DATES.items():
-        # Handle list of dates
-        future_dates = [d for d in dates if d >= now]
-        if future_dates:
-            found = True
-            next_exam = min(future_dates)
-            days_left = (next_exam - now).days
-            all_dates_str = ", ".join([d.strftime("%d/%m") for d in dates])
+    
+    for exam_name in exam_names:
+        ordinals, all_dates_str = _EXAM_META[exam_name]
+        # วันสอบถัดไป = ordinal แรกที่ >= วันนี้ (ordinals เรียงไว้แล้ว)
+        next_idx = bisect.bisect_left(ordinals, today_ord)
+        if next_idx < len(ordinals):
+            days_left = ordinals[next_idx] - today_ord
             
             if days_left == 0:
                 msg_list.append(f"🔥 วันนี้สอบ{exam_name}! สู้ๆ!")
@@ -277,10 +322,19 @@ def get_exam_countdown_message(user_message: str = "") -> TextMessage:
                     f"   (สอบวันที่ {all_dates_str})"
                 )
     
-    if not found:
-        return TextMessage(text="🎉 ยังไม่มีสอบเร็วๆ นี้ พักผ่อนได้!")
+    if len(msg_list) == 1:
+        return "🎉 ยังไม่มีสอบเร็วๆ นี้ พักผ่อนได้!"
     
-    return TextMessage(text="\n\n".join(msg_list))
+    return "\n\n".join(msg_list)
+
+_ALL_EXAM_NAMES = tuple(_EXAM_META)
+
+def get_exam_countdown_message(user_message: str = "") -> TextMessage:
+    """นับถอยหลังวันสอบ (Multi-date support)"""
+    # ถ้าระบุชื่อสอบ (เช่น "สอบกลางภาค") แสดงเฉพาะสอบนั้น ไม่งั้นแสดงทั้งหมด
+    exam_names = tuple(name for name in _ALL_EXAM_NAMES if name in user_message) or _ALL_EXAM_NAMES
+    today_ord = _DT.now(LOCAL_TZ).toordinal()
+    return TextMessage(text=_exam_countdown_text(today_ord, exam_names))
 
 # ============================================================================
 # MUSIC SEARCH
@@ -299,14 +353,14 @@ def extract_youtube_id(url_or_text: str) -> Optional[str]:
     return None
 
 def get_music_link_message(user_message: str) -> TextMessage:
-    """หาเพลงจาก YouTube (สร้างลิงก์ค้นหา)"""
+    """หาเพลงจาก YouTube (สร้างลิงก์ค้นหา) - user_message เป็นตัวพิมพ์เล็กแล้ว"""
     music_keywords = ["เปิดเพลง", "หาเพลง", "ขอเพลง"]
-    song_title = user_message.lower()
+    song_title = user_message
     
-    # ตัดคำสั่งออก
+    # ชื่อเพลงคือข้อความหลังคำสั่ง (ข้อความก่อนหน้าอาจเป็นคำสั่งอื่น)
     for keyword in music_keywords:
         if keyword in song_title:
-            song_title = song_title.replace(keyword, "").strip()
+            song_title = song_title.partition(keyword)[2].strip()
             break
     
     if not song_title:
@@ -332,7 +386,14 @@ def set_gemini_model(model):
     gemini_model = model
 
 def _safe_parse_gemini_response(response) -> str:
-    """Parse Gemini response safely"""
+    """Parse Gemini response safely (fast path for the SDK's response shape)"""
+    try:
+        return "".join(p.text for p in response.candidates[0].content.parts if p.text).strip()
+    except (AttributeError, IndexError, TypeError):
+        return _parse_gemini_response_fallback(response)
+
+def _parse_gemini_response_fallback(response) -> str:
+    """Parse any other Gemini response shape by probing attributes"""
     try:
         if response is None:
             return ""
@@ -353,38 +414,132 @@ def _safe_parse_gemini_response(response) -> str:
         logger.error("Error parsing Gemini response: %s", e)
         return ""
 
-def get_gemini_response(prompt: str) -> str:
-    """Get response from Gemini AI"""
+# คำถามเกี่ยวกับตัวตนของบอท ตอบเองโดยไม่ต้องเรียก AI (สแกนครั้งเดียวด้วย regex)
+_IDENTITY_QUERIES = ("คุณคือใคร", "เป็นใคร", "who are you", "คุณชื่ออะไร", "ชื่ออะไร", "ตัวตน")
+_IDENTITY_RE = re.compile("|".join(map(re.escape, _IDENTITY_QUERIES)))
+
+# ชื่อ Google (อังกฤษ/ไทย) ในคำตอบ AI แทนที่ด้วย Gemini ในการสแกนรอบเดียว
+_BRAND_RE = re.compile(r'\b[Gg]oogle\b|กูเกิล')
+
+@functools.lru_cache(maxsize=4)
+def _date_context(ordinal: int) -> str:
+    """ข้อความบริบทวันที่สำหรับ prompt (เปลี่ยนวันละครั้ง จึง cache ตามวัน)"""
+    d = _DATE.fromordinal(ordinal)
+    return f"วันนี้คือ{d.strftime('%A')}ที่ {d.strftime('%d %B')} พ.ศ. {d.year + 543}"
+
+class _EmptyGeminiResponse(Exception):
+    """Raised when Gemini returns no text (keeps empty answers out of the cache)"""
+
+def _ask_gemini(prompt: str, day: int) -> Tuple[str, bool]:
+    """
+    Call Gemini with the user's original text and post-process the answer
+    
+    day is the local date ordinal for the date context in the prompt
+    
+    Returns:
+        (text, complete) - complete is False when the answer was cut off at
+        max_output_tokens, so it must not be cached
+    """
+    # เพิ่ม context เวลาปัจจุบัน
+    date_context = _date_context(day)
+    enhanced_prompt = f"(บริบท: {date_context})\n\nคำถาม: {prompt}"
+    
+    response = gemini_model.generate_content(enhanced_prompt)
+    text = _safe_parse_gemini_response(response)
+    
+    # คำตอบโดนตัดเพราะชน max_output_tokens (รวม token ที่ใช้คิด) - log ไว้ปรับค่า
+    try:
+        finish_reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        finish_reason = None
+    complete = getattr(finish_reason, "name", finish_reason) not in ("MAX_TOKENS", 2)
+    if not complete:
+        logger.warning(
+            "Gemini hit max_output_tokens (%d chars returned); consider raising "
+            "GEMINI_MAX_OUTPUT_TOKENS", len(text)
+        )
+    
+    if not text:
+        raise _EmptyGeminiResponse()
+    
+    # ตัดข้อความถ้ายาวเกินไป (ตัดก่อนแทนที่ชื่อ เพราะความยาวเท่าเดิม
+    # จะได้ไม่ต้องสแกนส่วนที่ถูกตัดทิ้ง)
+    if len(text) > LINE_SAFE_TRUNCATE:
+        text = text[:LINE_SAFE_TRUNCATE].rstrip() + "...\n\n(ข้อความยาวเกินไป ตัดบางส่วน)"
+    
+    # แทนที่ชื่อ Google ด้วย Gemini
+    text = _BRAND_RE.sub('Gemini', text)
+    
+    return text, complete
+
+# LRU cache of answers: (normalized prompt, day, ttl_bucket) -> answer text.
+# The normalized text is only the key; Gemini always gets the original
+# prompt (case, line breaks and spacing intact), so functools.lru_cache
+# (which keys on every argument) doesn't fit here.
+_gemini_cache: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_gemini_cache_lock = threading.Lock()
+_gemini_cache_stats = {"hits": 0, "misses": 0}
+
+def _gemini_cached(key: str, day: int, ttl_bucket: int, prompt: str) -> str:
+    """
+    Answer prompt from the cache entry for key, asking Gemini on a miss
+
+    day (the local date of the prompt's date context) is part of the key,
+    so answers never outlive that date; ttl_bucket changes every
+    GEMINI_CACHE_TTL seconds (counted from the UTC epoch) on top of it.
+    Failures raise before anything is stored, and answers cut off at
+    max_output_tokens are returned but not stored, so both are retried.
+    """
+    cache_key = (key, day, ttl_bucket)
+    with _gemini_cache_lock:
+        text = _gemini_cache.get(cache_key)
+        if text is not None:
+            _gemini_cache.move_to_end(cache_key)
+            _gemini_cache_stats["hits"] += 1
+            return text
+        _gemini_cache_stats["misses"] += 1
+    
+    text, complete = _ask_gemini(prompt, day)
+    if not complete:
+        return text
+    
+    with _gemini_cache_lock:
+        _gemini_cache[cache_key] = text
+        _gemini_cache.move_to_end(cache_key)
+        while len(_gemini_cache) > GEMINI_CACHE_SIZE:
+            _gemini_cache.popitem(last=False)  # least recently used (old buckets go first)
+    return text
+
+def get_gemini_cache_stats() -> dict:
+    """Get Gemini response cache statistics (for monitoring)"""
+    with _gemini_cache_lock:
+        return {**_gemini_cache_stats, "size": len(_gemini_cache)}
+
+def get_gemini_response(prompt: str, prompt_lower: Optional[str] = None) -> str:
+    """
+    Get response from Gemini AI (cached per normalized prompt)
+    
+    Args:
+        prompt: User's message
+        prompt_lower: prompt already lowercased by the caller (skips lowering again)
+    """
+    # ยุบช่องว่างซ้ำ ๆ ให้คำถามเดียวกันใช้ cache ร่วมกัน (ใช้เป็น key เท่านั้น)
+    normalized = " ".join((prompt_lower if prompt_lower is not None else prompt.lower()).split())
+    
     # Identity check
-    identity_queries = ["คุณคือใคร", "เป็นใคร", "who are you", "คุณชื่ออะไร", "ชื่ออะไร", "ตัวตน"]
-    if any(q in prompt.lower() for q in identity_queries):
+    if _IDENTITY_RE.search(normalized):
         return MESSAGES["IDENTITY"]
     
     if not gemini_model:
         return MESSAGES["AI_DISABLED"]
     
+    day = _DT.now(LOCAL_TZ).toordinal()
     try:
-        # เพิ่ม context เวลาปัจจุบัน
-        now = datetime.datetime.now(LOCAL_TZ)
-        date_context = f"วันนี้คือ{now.strftime('%A')}ที่ {now.strftime('%d %B')} พ.ศ. {now.year + 543}"
-        enhanced_prompt = f"(บริบท: {date_context})\n\nคำถาม: {prompt}"
-        
-        response = gemini_model.generate_content(enhanced_prompt)
-        text = _safe_parse_gemini_response(response)
-        
-        if not text:
-            return MESSAGES["AI_NO_RESPONSE"]
-        
-        # แทนที่ชื่อ Google ด้วย Gemini
-        text = re.sub(r'\b[Gg]oogle\b', 'Gemini', text)
-        text = text.replace('กูเกิล', 'Gemini')
-        
-        # ตัดข้อความถ้ายาวเกินไป
-        if len(text) > LINE_SAFE_TRUNCATE:
-            text = text[:LINE_SAFE_TRUNCATE] + "...\n\n(ข้อความยาวเกินไป ตัดบางส่วน)"
-        
-        return text
-        
+        if not GEMINI_CACHE_ENABLED:
+            return _ask_gemini(prompt, day)[0]
+        return _gemini_cached(normalized, day, int(time.time() // GEMINI_CACHE_TTL), prompt)
+    except _EmptyGeminiResponse:
+        return MESSAGES["AI_NO_RESPONSE"]
     except Exception as e:
         logger.error("Gemini Generate Error: %s", e)
         return MESSAGES["AI_ERROR"]
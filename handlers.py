@@ -10,21 +10,31 @@ Improvements:
 - Performance optimizations
 """
 
+import atexit
+import logging
+import math
+import re
 import time
 import threading
-from typing import Dict, List, Optional, Union, Callable
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union, Callable
 from flask import request
+from urllib3.exceptions import HTTPError as TransportError
+from urllib3.util.retry import Retry
 
 from linebot.v3 import WebhookHandler
 from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage, ImageMessage
+    Configuration, ApiClient, MessagingApi, ReplyMessageRequest, PushMessageRequest,
+    TextMessage, ImageMessage, ApiException
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent
 
 # Import from config
 from config import (
     logger, ACCESS_TOKEN, CHANNEL_SECRET, MESSAGES,
-    RATE_LIMIT_MAX, RATE_LIMIT_WINDOW, ADMIN_USER_IDS
+    RATE_LIMIT_MAX, RATE_LIMIT_WINDOW, ADMIN_USER_IDS, AI_MIN_PROMPT_LENGTH,
+    AI_WORKER_THREADS, LINE_MAX_MESSAGES, LINE_KEEPALIVE_INTERVAL
 )
 
 # Import from features
@@ -44,119 +54,230 @@ import broadcast
 # LINE BOT CONFIGURATION
 # ============================================================================
 configuration = Configuration(access_token=ACCESS_TOKEN) if ACCESS_TOKEN else None
+if configuration:
+    # Retries are handled by urllib3 inside the shared pool (honours Retry-After
+    # on 429) instead of hand-written retry loops around each API call.
+    # LINE POSTs are not idempotent: only retry when the request surely was
+    # not processed (connection failed, or 429). A 5xx or read timeout may
+    # follow an accepted push, and a used reply token can't be replayed.
+    configuration.retries = Retry(
+        total=3,
+        connect=3,
+        read=0,
+        other=0,
+        backoff_factor=0.5,
+        status_forcelist=(429,),
+        allowed_methods=frozenset(["POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    # The pool defaults to cpu_count() * 5 connections; size it for every
+    # thread that can talk to LINE at once (webhook, AI and background
+    # workers) so a busy worker never drops a kept-alive TLS connection
+    configuration.connection_pool_maxsize = AI_WORKER_THREADS + 8
 handler = WebhookHandler(CHANNEL_SECRET) if CHANNEL_SECRET else None
 
 # ============================================================================
 # CONNECTION POOLING (Optimization)
 # ============================================================================
+# One ApiClient (and its urllib3 connection pool) for the whole process,
+# shared by replies, pushes and the broadcast module
+_api_client: Optional[ApiClient] = None
 _line_api_client: Optional[MessagingApi] = None
-_api_client_lock = threading.Lock()
+if configuration:
+    try:
+        _api_client = ApiClient(configuration)
+        _line_api_client = MessagingApi(_api_client)
+        logger.debug("LINE API client initialized")
+    except Exception as e:
+        logger.error("Failed to initialize LINE API client: %s", e)
 
 def get_line_api() -> Optional[MessagingApi]:
-    """Get or create LINE API client (singleton pattern for connection pooling)"""
-    global _line_api_client
-    
-    if _line_api_client is None and configuration:
-        with _api_client_lock:
-            if _line_api_client is None:
-                try:
-                    _line_api_client = MessagingApi(ApiClient(configuration))
-                    logger.debug("LINE API client initialized")
-                except Exception as e:
-                    logger.error(f"Failed to initialize LINE API client: {e}")
-    
+    """Get the shared LINE API client (connection pooling)"""
     return _line_api_client
 
+def _line_keepalive():
+    """Ping LINE periodically so a pooled TLS connection stays open (daemon thread)"""
+    while True:
+        time.sleep(LINE_KEEPALIVE_INTERVAL)
+        try:
+            _line_api_client.get_bot_info()
+        except (ApiException, TransportError) as e:
+            logger.debug("LINE keepalive ping failed: %s", e)
+
+if _line_api_client and LINE_KEEPALIVE_INTERVAL > 0:
+    threading.Thread(target=_line_keepalive, name="line-keepalive", daemon=True).start()
+
+@atexit.register
+def _close_line_api():
+    """Close the pooled connections on shutdown (worker pools have drained by now)"""
+    if _api_client is not None:
+        _api_client.close()  # async_req thread pool only
+        _api_client.rest_client.pool_manager.clear()  # the urllib3 sockets
+
 # ============================================================================
-# RATE LIMITING (Enhanced)
+# RATE LIMITING (Token Bucket, lock-striped)
 # ============================================================================
-_user_message_history: Dict[str, List[float]] = {}
-_rate_limit_lock = threading.Lock()
-_banned_users: Dict[str, float] = {}  # user_id -> ban_until_timestamp
+# user_id -> (tokens, last_refill_timestamp); timestamps come from time.monotonic()
+# ความจุ RATE_LIMIT_MAX token, เติมคืน RATE_LIMIT_MAX token ต่อ RATE_LIMIT_WINDOW วินาที
+# token ติดลบได้ = ข้อความที่ส่งเกิน ทำให้ต้องรอนานขึ้น (cooldown)
+#
+# State is split into shards keyed by hash(user_id), each with its own lock,
+# so webhooks from unrelated users don't contend on a single mutex.
+_RATE_LIMIT_SHARDS = 64  # power of two (shard index is a bit mask)
+_rate_limit_locks = [threading.Lock() for _ in range(_RATE_LIMIT_SHARDS)]
+_user_buckets: List[Dict[str, Tuple[float, float]]] = [{} for _ in range(_RATE_LIMIT_SHARDS)]
+_banned_users: List[Dict[str, float]] = [{} for _ in range(_RATE_LIMIT_SHARDS)]  # user_id -> ban_until (monotonic)
+_message_counts = [0] * _RATE_LIMIT_SHARDS
+_REFILL_RATE = RATE_LIMIT_MAX / RATE_LIMIT_WINDOW  # tokens per second
+RATE_LIMIT_STALE_AFTER = RATE_LIMIT_WINDOW * 10  # seconds idle before a bucket is evicted
+RATE_LIMIT_SWEEP_INTERVAL = 300  # seconds between background sweeps
 
-def is_rate_limited(user_id: str) -> bool:
+def _shard_index(user_id: str) -> int:
+    """Map user_id to its rate-limit shard"""
+    return hash(user_id) & (_RATE_LIMIT_SHARDS - 1)
+
+def _refill(buckets: Dict[str, Tuple[float, float]], user_id: str, now_ts: float) -> float:
+    """Get user's current token count after refill (caller must hold the shard lock)"""
+    tokens, last = buckets.get(user_id, (RATE_LIMIT_MAX, now_ts))
+    return min(RATE_LIMIT_MAX, tokens + (now_ts - last) * _REFILL_RATE)
+
+def is_rate_limited(user_id: str) -> Tuple[bool, int]:
     """
     Check if user is rate limited with enhanced protection
     
     Features:
-    - Sliding window rate limiting
-    - Exponential backoff for repeated violations
+    - Token bucket rate limiting (O(1) per check, two floats per user)
+    - Extended cooldown: messages over the limit put the bucket into debt
     - Temporary bans for severe abuse
+    
+    Returns:
+        (limited, retry_after_seconds) - retry_after is 0 when not limited
     """
-    now_ts = time.time()
+    now_ts = time.monotonic()
+    shard = _shard_index(user_id)
+    buckets = _user_buckets[shard]
+    banned = _banned_users[shard]
     
-    with _rate_limit_lock:
+    with _rate_limit_locks[shard]:
+        _message_counts[shard] += 1
+        
         # Check if user is banned
-        if user_id in _banned_users:
-            ban_until = _banned_users[user_id]
+        if user_id in banned:
+            ban_until = banned[user_id]
             if now_ts < ban_until:
-                remaining = int(ban_until - now_ts)
-                logger.warning(f"User {user_id} is banned for {remaining}s")
-                return True
+                remaining = math.ceil(ban_until - now_ts)
+                logger.warning("User %s is banned for %ss", user_id, remaining)
+                return True, remaining
             else:
                 # Ban expired
-                del _banned_users[user_id]
+                del banned[user_id]
+        
+        tokens = _refill(buckets, user_id, now_ts)
         
-        # Get user history
-        history = _user_message_history.get(user_id, [])
-        recent = [t for t in history if now_ts - t < RATE_LIMIT_WINDOW]
+        # Normal rate limit check
+        if tokens >= 1:
+            buckets[user_id] = (tokens - 1, now_ts)
+            return False, 0
         
-        # Check for severe abuse (3x rate limit)
-        if len(recent) > RATE_LIMIT_MAX * 3:
+        # Check for severe abuse (3x rate limit within a window)
+        if tokens <= -RATE_LIMIT_MAX * 2:
             # Ban for 5 minutes
-            _banned_users[user_id] = now_ts + 300
-            logger.error(f"User {user_id} BANNED for severe abuse ({len(recent)} msgs)")
-            return True
+            banned[user_id] = now_ts + 300
+            buckets.pop(user_id, None)
+            logger.error("User %s BANNED for severe abuse", user_id)
+            return True, 300
+        
+        tokens -= 1
+        buckets[user_id] = (tokens, now_ts)
         
         # Check for moderate abuse (2x rate limit)
-        if len(recent) > RATE_LIMIT_MAX * 2:
+        if tokens <= -RATE_LIMIT_MAX:
             # Extended cooldown
-            logger.warning(f"User {user_id} in extended cooldown ({len(recent)} msgs)")
-            return True
-        
-        # Normal rate limit check
-        recent.append(now_ts)
-        _user_message_history[user_id] = recent
-        
-        if len(recent) > RATE_LIMIT_MAX:
-            logger.info(f"User {user_id} rate limited ({len(recent)}/{RATE_LIMIT_MAX})")
-            return True
-    
-    return False
+            logger.warning("User %s in extended cooldown (%.1f tokens)", user_id, tokens)
+        else:
+            logger.info("User %s rate limited (%.1f tokens)", user_id, tokens)
+        # Time until the bucket is back to one whole token
+        return True, math.ceil((1 - tokens) / _REFILL_RATE)
 
 def get_rate_limit_status(user_id: str) -> dict:
     """Get rate limit status for user (for monitoring)"""
-    now_ts = time.time()
+    now_ts = time.monotonic()
+    shard = _shard_index(user_id)
     
-    with _rate_limit_lock:
-        if user_id in _banned_users:
+    with _rate_limit_locks[shard]:
+        banned = _banned_users[shard]
+        if user_id in banned:
+            remaining = banned[user_id] - now_ts
             return {
                 "status": "banned",
-                "ban_until": _banned_users[user_id],
-                "remaining_seconds": int(_banned_users[user_id] - now_ts)
+                "ban_until": time.time() + remaining,  # wall clock, for display
+                "remaining_seconds": int(remaining)
             }
         
-        history = _user_message_history.get(user_id, [])
-        recent = [t for t in history if now_ts - t < RATE_LIMIT_WINDOW]
+        tokens = _refill(_user_buckets[shard], user_id, now_ts)
         
         return {
-            "status": "rate_limited" if len(recent) > RATE_LIMIT_MAX else "ok",
-            "messages_count": len(recent),
+            "status": "rate_limited" if tokens < 1 else "ok",
+            "tokens": round(tokens, 2),
             "limit": RATE_LIMIT_MAX,
             "window_seconds": RATE_LIMIT_WINDOW
         }
 
+def sweep_stale_rate_limits() -> int:
+    """
+    Drop buckets idle for more than RATE_LIMIT_STALE_AFTER and expired bans
+    
+    An idle bucket has long since refilled to capacity, so deleting it is
+    equivalent to keeping it. Returns the number of entries removed.
+    """
+    now_ts = time.monotonic()
+    removed = 0
+    for shard in range(_RATE_LIMIT_SHARDS):
+        with _rate_limit_locks[shard]:
+            buckets = _user_buckets[shard]
+            for uid in [u for u, (_, last) in buckets.items() if now_ts - last > RATE_LIMIT_STALE_AFTER]:
+                del buckets[uid]
+                removed += 1
+            banned = _banned_users[shard]
+            for uid in [u for u, until in banned.items() if now_ts >= until]:
+                del banned[uid]
+                removed += 1
+    return removed
+
+def _rate_limit_sweeper():
+    """Background loop evicting stale rate-limit entries (daemon thread)"""
+    while True:
+        time.sleep(RATE_LIMIT_SWEEP_INTERVAL)
+        try:
+            removed = sweep_stale_rate_limits()
+            if removed:
+                logger.debug("Rate limiter swept %s stale entries", removed)
+        except Exception as e:
+            logger.error("Rate limit sweep failed: %s", e)
+
+threading.Thread(target=_rate_limit_sweeper, name="rate-limit-sweeper", daemon=True).start()
+
+def get_rate_limit_stats() -> dict:
+    """Get rate limiter totals (for /stats)"""
+    stats = {"tracked_users": 0, "total_messages": 0, "banned_users": 0}
+    for shard in range(_RATE_LIMIT_SHARDS):
+        with _rate_limit_locks[shard]:
+            stats["tracked_users"] += len(_user_buckets[shard])
+            stats["total_messages"] += _message_counts[shard]
+            stats["banned_users"] += len(_banned_users[shard])
+    return stats
+
 # ============================================================================
 # COMMAND MATCHING & DISPATCHING (Optimized)
 # ============================================================================
 
-def _keyword_matches(message_lower: str, keyword_lower: str) -> bool:
-    """Check if keyword matches in message"""
-    return keyword_lower in message_lower
-
 def call_action(action: Callable, user_message: str) -> Union[TextMessage, ImageMessage]:
     """
-    Call action function with proper argument handling and error recovery
+    Call action function with error recovery
+    
+    Every action in COMMANDS takes the (lowercased) message, most with a
+    default they ignore, so the message is always passed.
     
     Args:
         action: Function to call
@@ -166,16 +287,13 @@ def call_action(action: Callable, user_message: str) -> Union[TextMessage, Image
         TextMessage or ImageMessage response
     """
     try:
-        # Check if function accepts arguments
-        if action.__code__.co_argcount > 0:
-            return action(user_message)
-        else:
-            return action()
+        return action(user_message)
     except Exception as e:
-        logger.exception(f"Error calling action {action.__name__}: {e}")
+        logger.exception("Error calling action %s: %s", action.__name__, e)
         return TextMessage(text=MESSAGES.get("ACTION_ERROR", "เกิดข้อผิดพลาด กรุณาลองใหม่"))
 
 # COMMANDS LIST - Order matters! (most specific first)
+# Actions that take an argument receive the message already lowercased
 COMMANDS = [
     # งาน & ลิงก์พื้นฐาน
     (("งาน", "การบ้าน", "เช็คงาน", "ใบงาน"), get_worksheet_message),
@@ -202,6 +320,117 @@ COMMANDS = [
     (("คำสั่ง", "help", "ช่วยเหลือ"), get_help_message),
 ]
 
+def _trie_pattern(words) -> str:
+    """
+    Build a prefix-factored regex (a trie) that matches the longest of words
+    
+    Unlike a flat "a|b|c" alternation, which re tries one branch at a time,
+    the trie shares common prefixes so each position is walked once, like an
+    Aho-Corasick goto function.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}  # end-of-word marker
+    
+    def build(node: dict) -> str:
+        alts = [re.escape(ch) + build(child) for ch, child in node.items() if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        # Greedy optional: prefer the longer keyword, backtrack to this one
+        return "(?:" + body + ")?" if "" in node else body
+    
+    return build(trie)
+
+# keyword (lowercase) -> (priority, action); priority = ลำดับใน COMMANDS
+_KEYWORD_ACTIONS: Dict[str, Tuple[int, Callable]] = {}
+for _priority, (_keywords, _action) in enumerate(COMMANDS):
+    for _kw in _keywords:
+        _KEYWORD_ACTIONS.setdefault(_kw.lower(), (_priority, _action))
+
+# คำสั่งที่ข้อความหลัง keyword เป็น argument (เช่น ชื่อเพลง) - หยุดหาคำสั่งต่อ
+_ARGUMENT_ACTIONS = (get_music_link_message,)
+
+# keyword ที่สั้นขนาดนี้ต้องเป็นคำเดี่ยว (มีช่องว่าง/ต้น-ท้ายข้อความคั่น)
+# ไม่งั้น "ลา" จะไปเจอใน "เวลา", "กลาง", "ลาก่อน"
+_SHORT_KEYWORD_LEN = 2
+
+# One pattern for every keyword. The zero-width lookahead lets finditer try
+# every position, so overlapping keywords are all seen; at each position the
+# trie yields the longest keyword.
+_KEYWORD_RE = re.compile("(?=(" + _trie_pattern(_KEYWORD_ACTIONS) + "))")
+
+def _is_word_char(ch: str) -> bool:
+    """Letters, digits and combining marks (Thai vowels/tone marks) join words"""
+    return ch.isalnum() or unicodedata.category(ch).startswith("M")
+
+def _stands_alone(message: str, start: int, end: int) -> bool:
+    """True if message[start:end] is not glued to a word on either side"""
+    return (
+        (start == 0 or not _is_word_char(message[start - 1]))
+        and (end == len(message) or not _is_word_char(message[end]))
+    )
+
+def match_commands(message_lower: str, limit: int = LINE_MAX_MESSAGES) -> List[Tuple[str, Callable]]:
+    """
+    Find every command in a lowercased message in a single regex scan
+    
+    A keyword matches anywhere in the message, except inside a longer
+    keyword, and short keywords ("ลา") only as a word of their own, so
+    "เหลือเวลา", "สอบกลางภาค" and "ลาก่อน" are not leave requests. The
+    scan stops at a command that takes the rest of the message as its
+    argument ("เปิดเพลง ตารางเรียน" only searches for music). Each command
+    is returned once, in the order it appears in the message, at most
+    limit of them so the answers fit in one reply.
+    
+    Returns:
+        List of (matched_keyword, action)
+    """
+    hits: Dict[int, str] = {}  # priority -> keyword, in message order
+    covered_until = 0
+    for m in _KEYWORD_RE.finditer(message_lower):
+        keyword = m.group(1)
+        start = m.start()
+        end = start + len(keyword)
+        if end <= covered_until:
+            continue  # inside the previous, longer keyword
+        if len(keyword) <= _SHORT_KEYWORD_LEN and not _stands_alone(message_lower, start, end):
+            continue
+        covered_until = end
+        priority, action = _KEYWORD_ACTIONS[keyword]
+        hits.setdefault(priority, keyword)
+        if action in _ARGUMENT_ACTIONS or len(hits) >= limit:
+            break
+    
+    return [(keyword, COMMANDS[priority][1]) for priority, keyword in hits.items()]
+
+def match_command(message_lower: str) -> Optional[Tuple[str, Callable]]:
+    """
+    Find the first command in a lowercased message
+    
+    Returns:
+        (matched_keyword, action) or None
+    """
+    matched = match_commands(message_lower, 1)
+    return matched[0] if matched else None
+
+# Rich Menu buttons send a bare keyword, so the whole message is usually
+# exactly one keyword: answer those with one dict probe. Resolved through
+# match_commands at import so the result is identical to the scan.
+_EXACT_COMMANDS: Dict[str, List[Tuple[str, Callable]]] = {
+    kw: match_commands(kw) for kw in _KEYWORD_ACTIONS
+}
+
+def find_commands(message_lower: str) -> List[Tuple[str, Callable]]:
+    """Exact keyword lookup first, falling back to the full scan"""
+    hit = _EXACT_COMMANDS.get(message_lower)
+    if hit is not None:
+        return hit
+    return match_commands(message_lower)
+
 # ============================================================================
 # LINE REPLY HELPER (Optimized with connection pooling)
 # ============================================================================
@@ -233,29 +462,141 @@ def reply_to_line(reply_token: str, messages: List[Union[TextMessage, ImageMessa
                 messages=messages
             )
         )
-        logger.debug(f"Successfully replied with {len(messages)} message(s)")
+        logger.debug("Successfully replied with %d message(s)", len(messages))
         return True
-    except Exception as e:
-        logger.error(f"LINE Reply Error: {e}")
+    except (ApiException, TransportError) as e:
+        logger.error("LINE Reply Error: %s", e)
+        return False
+
+def push_to_line(to: str, messages: List[Union[TextMessage, ImageMessage]]) -> bool:
+    """
+    Push messages to a user/group/room (used when the reply token is no longer valid)
+    
+    Returns:
+        True if successful, False otherwise
+    """
+    line_bot_api = get_line_api()
+    if not line_bot_api:
+        logger.error("LINE API client not available")
+        return False
+    
+    try:
+        line_bot_api.push_message(PushMessageRequest(to=to, messages=messages))
+        return True
+    except (ApiException, TransportError) as e:
+        logger.error("LINE Push Error: %s", e)
         return False
 
+# ============================================================================
+# BACKGROUND WORKERS (slow work runs off the webhook thread)
+# ============================================================================
+# Signature check, rate limiting and quick commands stay inline;
+# Gemini, Firebase work, broadcasts and LINE replies go here.
+_ai_executor = ThreadPoolExecutor(max_workers=AI_WORKER_THREADS, thread_name_prefix="ai-worker")
+# User-facing Firestore commands (homework, admin stats)
+_bg_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="bg-worker")
+# A broadcast pushes to every user, and every message writes track_user:
+# each gets its own pool so neither can hold a command reply until its
+# reply token expires
+_broadcast_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="broadcast-worker")
+_track_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="track-worker")
+# Plain replies get their own pool so they never queue behind Firestore writes
+_reply_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="reply-worker")
+
+def _log_task_failure(future):
+    """Done-callback: log anything a background task raised (nobody awaits the future)"""
+    error = future.exception()
+    if error is not None:
+        logger.error("Background task failed: %r", error, exc_info=error)
+
+def _submit(executor: ThreadPoolExecutor, fn: Callable, *args):
+    """Submit fire-and-forget work so its exceptions are still logged"""
+    executor.submit(fn, *args).add_done_callback(_log_task_failure)
+
+def reply_async(reply_token: str, messages: List[Union[TextMessage, ImageMessage]]):
+    """Send a reply without holding the webhook response"""
+    _submit(_reply_executor, reply_to_line, reply_token, messages)
+
+def _push_target(event) -> Optional[str]:
+    """Get the chat to push to: group/room if the message came from one, else the user"""
+    source = getattr(event, "source", None)
+    return (
+        getattr(source, "group_id", None)
+        or getattr(source, "room_id", None)
+        or getattr(source, "user_id", None)
+    )
+
+def _answer_with_ai(reply_token: str, push_to: Optional[str], user_message: str, user_message_lower: str):
+    """Ask Gemini and deliver the answer (runs in _ai_executor)"""
+    try:
+        reply_message = TextMessage(text=get_gemini_response(user_message, user_message_lower))
+    except Exception as e:
+        logger.exception("Gemini API error: %s", e)
+        reply_message = TextMessage(text=MESSAGES["AI_ERROR"])
+    
+    _deliver(reply_token, push_to, [reply_message])
+
+def _deliver(reply_token: str, push_to: Optional[str], messages: List[Union[TextMessage, ImageMessage]]):
+    """Reply, or push if the reply token expired while a worker was busy"""
+    # Reply tokens are free but expire; fall back to a push
+    if reply_to_line(reply_token, messages):
+        return
+    if push_to:
+        push_to_line(push_to, messages)
+    else:
+        logger.error("Failed to deliver background answer: reply failed and no push target")
+
+def _run_db_command(reply_token: str, push_to: Optional[str], build: Callable[[], TextMessage]):
+    """Run a Firestore-backed command and deliver its reply (runs in _bg_executor)"""
+    try:
+        reply_message = build()
+    except Exception as e:
+        logger.exception("Database command failed: %s", e)
+        reply_message = ACTION_ERROR_REPLY
+    _deliver(reply_token, push_to, [reply_message])
+
+def _run_broadcast(reply_token: str, push_to: Optional[str], admin_id: str, message):
+    """Send an admin broadcast and report the result (runs in _broadcast_executor)"""
+    try:
+        result = broadcast.broadcast_message(message)
+        broadcast.save_broadcast_history(admin_id, message, result)
+        report = TextMessage(text=result['message'])
+    except Exception as e:
+        logger.exception("Broadcast failed: %s", e)
+        report = TextMessage(text=MESSAGES["ACTION_ERROR"])
+    _deliver(reply_token, push_to, [report])
+
 # ============================================================================
 # EVENT HANDLERS
 # ============================================================================
 
+# Built once and reused for every FollowEvent
+WELCOME_MESSAGE = TextMessage(
+    text='👋 สวัสดีครับ! ผมคือ MTC Assistant\n'
+         'ผู้ช่วยอเนกประสงค์ของห้อง ม.4/2\n\n'
+         'พิมพ์ "คำสั่ง" เพื่อดูรายการคำสั่งทั้งหมดนะครับ'
+)
+
+# Fixed replies used by handle_message, likewise built once
+INVALID_MESSAGE_REPLY = TextMessage(text=MESSAGES["INVALID_MESSAGE"])
+MESSAGE_TOO_SHORT_REPLY = TextMessage(text=MESSAGES["MESSAGE_TOO_SHORT"])
+ACTION_ERROR_REPLY = TextMessage(text=MESSAGES["ACTION_ERROR"])
+RATE_LIMITED_REPLY = TextMessage(text=MESSAGES["RATE_LIMITED"])
+
+def _rate_limited_reply(user_id: str, retry_after: int) -> TextMessage:
+    """Banned users are told how long to wait; throttled ones get the fixed reply"""
+    if get_rate_limit_status(user_id)["status"] == "banned":
+        return TextMessage(text=MESSAGES["BANNED"].format(seconds=retry_after))
+    return RATE_LIMITED_REPLY
+
 @handler.add(FollowEvent) if handler else (lambda f: f)
 def handle_follow(event):
     """Handle user following the bot"""
-    welcome_message = TextMessage(
-        text='👋 สวัสดีครับ! ผมคือ MTC Assistant\n'
-             'ผู้ช่วยอเนกประสงค์ของห้อง ม.4/2\n\n'
-             'พิมพ์ "คำสั่ง" เพื่อดูรายการคำสั่งทั้งหมดนะครับ'
-    )
     try:
-        reply_to_line(event.reply_token, [welcome_message])
-        logger.info("Sent follow welcome message")
+        reply_async(event.reply_token, [WELCOME_MESSAGE])
+        logger.info("Queued follow welcome message")
     except Exception as e:
-        logger.exception(f"Failed to send follow reply: {e}")
+        logger.exception("Failed to send follow reply: %s", e)
 
 @handler.add(MessageEvent, message=TextMessageContent) if handler else (lambda f: f)
 def handle_message(event):
@@ -264,39 +605,33 @@ def handle_message(event):
     user_message = user_text.strip()
     
     if not user_message:
-        reply_to_line(event.reply_token, [TextMessage(text=MESSAGES["INVALID_MESSAGE"])])
+        reply_async(event.reply_token, [INVALID_MESSAGE_REPLY])
         return
     
     # Get user ID for rate limiting
-    user_id = None
     try:
-        user_id = event.source.user_id if hasattr(event, "source") else None
-    except Exception:
+        user_id = event.source.user_id
+    except AttributeError:
         user_id = None
     
     if not user_id:
         user_id = f"anon-{request.remote_addr or 'unknown'}"
     
-    logger.info("Message from %s: %s", user_id, user_message[:100])
-    
-    # Track user for broadcast (เก็บ user_id ไว้ใน Firebase)
-    try:
-        broadcast.track_user(user_id)
-    except Exception as e:
-        logger.error(f"Failed to track user: {e}")
-    
-    # Check rate limit
-    if is_rate_limited(user_id):
-        rate_status = get_rate_limit_status(user_id)
-        if rate_status["status"] == "banned":
-            reply_message = TextMessage(
-                text=f"⛔ คุณถูกระงับชั่วคราวเนื่องจากส่งข้อความมากเกินไป\n"
-                     f"กรุณารออีก {rate_status['remaining_seconds']} วินาที"
-            )
-        else:
-            reply_message = TextMessage(text=MESSAGES["RATE_LIMITED"])
-        
-        reply_to_line(event.reply_token, [reply_message])
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Message from %s: %s", user_id, user_message[:100])
+    
+    # Track user for broadcast (เก็บ user_id ไว้ใน Firebase) - a Firestore
+    # write, so it runs in the background; track_user logs its own errors
+    _submit(_track_executor, broadcast.track_user, user_id)
+    
+    # Check rate limit - the throttled sender gets the rate-limited reply
+    # (or, when banned, how long to wait).
+    # The webhook itself still answers 200: a delivery can batch events from
+    # several users, and a redelivery would replay the ones already handled.
+    limited, retry_after = is_rate_limited(user_id)
+    if limited:
+        logger.debug("Rate limited %s for %ds", user_id, retry_after)
+        reply_async(event.reply_token, [_rate_limited_reply(user_id, retry_after)])
         return
     
     user_message_lower = user_message.lower()
@@ -314,9 +649,10 @@ def handle_message(event):
                     "ประกาศจากผู้ดูแล", 
                     message_to_broadcast
                 )
-                result = broadcast.broadcast_message(announcement)
-                broadcast.save_broadcast_history(user_id, announcement, result)
-                reply_message = TextMessage(text=result['message'])
+                _submit(
+                    _broadcast_executor, _run_broadcast, event.reply_token, _push_target(event), user_id, announcement
+                )
+                return
             else:
                 reply_message = TextMessage(
                     text="⚠️ รูปแบบ: ประกาศ [ข้อความ]\nตัวอย่าง: ประกาศ พรุ่งนี้มีสอบฟิสิกส์"
@@ -327,9 +663,10 @@ def handle_message(event):
             urgent_msg = user_message.replace("ประกาศด่วน ", "", 1).strip()
             if urgent_msg:
                 alert = broadcast.create_urgent_alert(urgent_msg)
-                result = broadcast.broadcast_message(alert)
-                broadcast.save_broadcast_history(user_id, alert, result)
-                reply_message = TextMessage(text=result['message'])
+                _submit(
+                    _broadcast_executor, _run_broadcast, event.reply_token, _push_target(event), user_id, alert
+                )
+                return
             else:
                 reply_message = TextMessage(
                     text="⚠️ รูปแบบ: ประกาศด่วน [ข้อความ]\nตัวอย่าง: ประกาศด่วน วันนี้เลิกเรียนเร็ว!"
@@ -340,9 +677,10 @@ def handle_message(event):
             reminder_msg = user_message.replace("เตือนการบ้าน ", "", 1).strip()
             if reminder_msg:
                 reminder = broadcast.create_reminder("การบ้าน", reminder_msg)
-                result = broadcast.broadcast_message(reminder)
-                broadcast.save_broadcast_history(user_id, reminder, result)
-                reply_message = TextMessage(text=result['message'])
+                _submit(
+                    _broadcast_executor, _run_broadcast, event.reply_token, _push_target(event), user_id, reminder
+                )
+                return
             else:
                 reply_message = TextMessage(
                     text="⚠️ รูปแบบ: เตือนการบ้าน [รายละเอียด]\n"
@@ -351,12 +689,19 @@ def handle_message(event):
         
         # ดูสถิติ Broadcast
         elif user_message in ["สถิติประกาศ", "broadcast stats", "stats broadcast"]:
-            reply_message = TextMessage(text=broadcast.get_broadcast_stats())
+            _submit(
+                _bg_executor, _run_db_command, event.reply_token, _push_target(event),
+                lambda: TextMessage(text=broadcast.get_broadcast_stats())
+            )
+            return
         
         # จำนวนผู้ใช้
         elif user_message in ["จำนวนผู้ใช้", "user count", "ผู้ใช้"]:
-            count = broadcast.get_user_count()
-            reply_message = TextMessage(text=f"👥 จำนวนผู้ใช้ทั้งหมด: {count} คน")
+            _submit(
+                _bg_executor, _run_db_command, event.reply_token, _push_target(event),
+                lambda: TextMessage(text=f"👥 จำนวนผู้ใช้ทั้งหมด: {broadcast.get_user_count()} คน")
+            )
+            return
         
         # คำสั่ง Admin Help
         elif user_message in ["admin", "คำสั่งแอดมิน"]:
@@ -388,66 +733,62 @@ def handle_message(event):
             "สั่งการบ้าน | คณิต | แบบฝึกหัดท้ายบท 2 ข้อคู่ | วันศุกร์\n"
             "สั่งการบ้าน | ฟิสิกส์ | สรุปสูตรบทการเคลื่อนที่ | 20 ต.ค."
         )
-        reply_to_line(event.reply_token, [TextMessage(text=instruction_msg)])
+        reply_async(event.reply_token, [TextMessage(text=instruction_msg)])
         return
     
     # ===============================================
-    # Check Firebase Commands First
+    # Check Firebase Commands First (Firestore runs in _bg_executor)
     # ===============================================
+    db_command = None
     if not reply_message and user_message.startswith("สั่งการบ้าน"):
-        reply_message = _handle_add_homework(user_message)
+        db_command = lambda: _handle_add_homework(user_message)
     
     elif not reply_message and user_message in ["การบ้าน", "ดูการบ้าน", "homework"]:
-        reply_message = TextMessage(text=get_homeworks_from_db())
+        db_command = lambda: TextMessage(text=get_homeworks_from_db())
     
     elif not reply_message and user_message in ["ลบการบ้านทั้งหมด", "clear hw", "ลบงาน"]:
-        reply_message = TextMessage(text=clear_homework_db())
+        db_command = lambda: TextMessage(text=clear_homework_db())
+    
+    if db_command:
+        _submit(_bg_executor, _run_db_command, event.reply_token, _push_target(event), db_command)
+        return
     
     # ===============================================
     # Try Standard Commands
     # ===============================================
+    # Every command in the message is answered in the same reply
+    # (e.g. "งาน ตารางสอน เกรด"), up to LINE_MAX_MESSAGES
+    reply_messages = None
     if not reply_message:
-        for keywords, action in COMMANDS:
-            matched = False
-            # เรียงจากยาวไปสั้น เพื่อจับ keyword ที่ specific ก่อน
-            for keyword in sorted(keywords, key=len, reverse=True):
-                if _keyword_matches(user_message_lower, keyword.lower()):
-                    try:
-                        reply_message = call_action(action, user_message)
-                        logger.debug("Matched command: %s for user %s", keyword, user_id)
-                    except Exception as e:
-                        logger.exception("Error executing action for keyword %s: %s", keyword, e)
-                        reply_message = TextMessage(text=MESSAGES["ACTION_ERROR"])
-                    matched = True
-                    break
-            
-            if matched:
-                break
+        matched = find_commands(user_message_lower)
+        if matched:
+            # call_action turns any action error into the action-error reply
+            reply_messages = []
+            for keyword, action in matched:
+                reply_messages.append(call_action(action, user_message_lower))
+                logger.debug("Matched command: %s for user %s", keyword, user_id)
+            reply_message = reply_messages[0]
+    
+    # ===============================================
+    # Skip AI for trivially short messages (e.g. a single emoji)
+    # ===============================================
+    if not reply_message and len(user_message) < AI_MIN_PROMPT_LENGTH:
+        reply_message = MESSAGE_TOO_SHORT_REPLY
     
     # ===============================================
     # Fallback to Gemini AI
     # ===============================================
     if not reply_message:
         logger.debug("No command matched, using Gemini API for user %s", user_id)
-        try:
-            ai_response_text = get_gemini_response(user_message)
-            reply_message = TextMessage(text=ai_response_text)
-        except Exception as e:
-            logger.exception(f"Gemini API error: {e}")
-            reply_message = TextMessage(text=MESSAGES["AI_ERROR"])
+        _submit(
+            _ai_executor, _answer_with_ai, event.reply_token, _push_target(event), user_message, user_message_lower
+        )
+        return
     
     # ===============================================
-    # Send Reply
+    # Send Reply (off the webhook thread)
     # ===============================================
-    try:
-        if reply_message:
-            success = reply_to_line(event.reply_token, [reply_message])
-            if not success:
-                logger.error("Failed to send reply to user %s", user_id)
-        else:
-            logger.warning("No reply generated for message from %s: %s", user_id, user_message)
-    except Exception as e:
-        logger.exception(f"Failed to send reply to LINE for user {user_id}: {e}")
+    reply_async(event.reply_token, reply_messages or [reply_message])
 
 # ============================================================================
 # HOMEWORK COMMAND HANDLER
@@ -496,7 +837,13 @@ __all__ = [
     'handle_follow',
     'handle_message',
     'reply_to_line',
+    'reply_async',
+    'push_to_line',
     'is_rate_limited',
     'get_rate_limit_status',
+    'get_rate_limit_stats',
     'get_line_api',
+    'match_command',
+    'match_commands',
+    'find_commands',
 ]
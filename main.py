@@ -11,9 +11,10 @@ Improvements:
 - Performance monitoring
 """
 
+import logging
 import os
-import datetime
 import time
+from datetime import datetime as _DT
 from flask import Flask, request, abort, jsonify, g
 
 # Firebase imports
@@ -30,10 +31,10 @@ from linebot.v3.exceptions import InvalidSignatureError
 from config import (
     logger, setup_logging, validate_config,
     PORT, FLASK_DEBUG, ACCESS_TOKEN, CHANNEL_SECRET, GEMINI_API_KEY,
-    FIREBASE_KEY_PATH, GEMINI_MODEL_NAME, LOCAL_TZ
+    FIREBASE_KEY_PATH, GEMINI_MODEL_NAME, GEMINI_MAX_OUTPUT_TOKENS, GEMINI_SYSTEM_INSTRUCTION, LOCAL_TZ
 )
 
-from handlers import handler
+from handlers import handler, get_line_api
 
 import features  # Import features module to set global variables
 import broadcast  # Import broadcast module
@@ -77,9 +78,9 @@ def after_request(response):
         _metrics["total_response_time"] += elapsed
         
         if elapsed > 1000:  # Log slow requests
-            logger.warning(f"Slow request to {request.path}: {elapsed:.2f}ms")
+            logger.warning("Slow request to %s: %.2fms", request.path, elapsed)
         else:
-            logger.debug(f"Request to {request.path}: {elapsed:.2f}ms")
+            logger.debug("Request to %s: %.2fms", request.path, elapsed)
     
     return response
 
@@ -97,9 +98,9 @@ try:
         broadcast.set_database(db)  # Set database in broadcast module
         logger.info("🔥 Firebase Connected Successfully!")
     else:
-        logger.warning(f"⚠️ Missing {FIREBASE_KEY_PATH}. Homework DB features will be disabled.")
+        logger.warning("⚠️ Missing %s. Homework DB features will be disabled.", FIREBASE_KEY_PATH)
 except Exception as e:
-    logger.exception(f"❌ Firebase Init Error: {e}")
+    logger.exception("❌ Firebase Init Error: %s", e)
 
 # ============================================================================
 # GEMINI AI INITIALIZATION
@@ -108,20 +109,25 @@ gemini_model = None
 if GEMINI_API_KEY:
     try:
         genai.configure(api_key=GEMINI_API_KEY)
-        gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        # The system instruction keeps answers LINE-sized; max_output_tokens only
+        # bounds thinking + answer. features still truncates as a safety net
+        gemini_model = genai.GenerativeModel(
+            GEMINI_MODEL_NAME,
+            generation_config={"max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS},
+            system_instruction=GEMINI_SYSTEM_INSTRUCTION,
+        )
         features.set_gemini_model(gemini_model)  # Set model in features module
-        logger.info(f"🤖 Gemini model '{GEMINI_MODEL_NAME}' instantiated.")
+        logger.info("🤖 Gemini model '%s' instantiated.", GEMINI_MODEL_NAME)
     except Exception as e:
-        logger.error(f"❌ Gemini model init failed: {e}")
+        logger.error("❌ Gemini model init failed: %s", e)
         gemini_model = None
 
 # ============================================================================
 # LINE API INITIALIZATION (for Broadcast)
 # ============================================================================
-from linebot.v3.messaging import Configuration as LineConfig
-line_config = LineConfig(access_token=ACCESS_TOKEN) if ACCESS_TOKEN else None
-if line_config:
-    broadcast.set_line_api(line_config)
+line_api = get_line_api()
+if line_api:
+    broadcast.set_line_api(line_api)
     logger.info("📢 Broadcast system initialized")
 
 # ============================================================================
@@ -131,14 +137,18 @@ if line_config:
 @app.route("/callback", methods=['POST'])
 def callback():
     """Handle LINE webhook callback"""
-    signature = request.headers.get('X-Line-Signature') or request.headers.get('x-line-signature')
-    if not signature:
-        logger.error("Missing X-Line-Signature header.")
+    # Uptime monitors and scanners hit the webhook without a signature or body;
+    # reject them before reading the body (header lookup is case-insensitive)
+    signature = request.headers.get('X-Line-Signature')
+    if not signature or not request.content_length:
+        logger.debug("Rejected unsigned or empty webhook request")
         _metrics["total_errors"] += 1
-        abort(400)
+        return "", 400
     
-    body = request.get_data(as_text=True)
-    logger.debug("Request body: %s", body[:200])
+    # Read the raw body once (no cached copy kept by Werkzeug) and never parse
+    # JSON here: handler.handle verifies the HMAC-SHA256 signature with
+    # hmac.compare_digest over these exact bytes before parsing the events.
+    body = request.get_data(cache=False, as_text=True)
     
     if handler is None:
         logger.error("Webhook handler not configured (missing CHANNEL_SECRET).")
@@ -152,9 +162,15 @@ def callback():
         _metrics["total_errors"] += 1
         abort(400)
     except Exception as e:
+        # Still acknowledge: a non-2xx makes LINE redeliver the whole batch,
+        # and events already handled would be answered twice
         logger.exception("Error handling request: %s", e)
         _metrics["total_errors"] += 1
-        abort(500)
+        return "OK", 200
+    
+    # Only bodies that passed signature verification reach the log
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Request body: %s", body[:200])
     
     return "OK", 200
 
@@ -164,7 +180,7 @@ def home():
     cfg_ok = "OK" if ACCESS_TOKEN and CHANNEL_SECRET else "CONFIG_MISSING"
     gemini_status = "OK" if GEMINI_API_KEY else "MISSING"
     db_status = "OK" if db else "DISCONNECTED"
-    broadcast_status = "OK" if line_config else "DISABLED"
+    broadcast_status = "OK" if line_api else "DISABLED"
     
     uptime = int(time.time() - _metrics["start_time"])
     
@@ -187,16 +203,32 @@ def home():
         f"  /stats - Bot statistics\n"
     )
 
+# Probes can hit /healthz every second; reuse the last result (including the
+# Firestore round trip) for a few seconds instead of rebuilding it each time
+HEALTHZ_CACHE_TTL = 5.0  # seconds
+_healthz_cache = {"response": (b"", 200), "expires": 0.0}
+
 @app.route("/healthz", methods=['GET'])
 def healthz():
-    """Enhanced health check endpoint with connectivity test"""
+    """Enhanced health check endpoint with connectivity test (cached briefly)"""
+    now = time.monotonic()
+    if now >= _healthz_cache["expires"]:
+        response, status_code = _build_health_response()
+        # Body and status are swapped in together so readers never mix them
+        _healthz_cache["response"] = (response.get_data(), status_code)
+        _healthz_cache["expires"] = now + HEALTHZ_CACHE_TTL
+    body, status_code = _healthz_cache["response"]
+    return app.response_class(body, status=status_code, mimetype="application/json")
+
+def _build_health_response():
+    """Run the health checks and build the JSON response"""
     start_time = time.time()
     
     services_status = {
         "line": bool(ACCESS_TOKEN and CHANNEL_SECRET),
         "gemini": bool(GEMINI_API_KEY and gemini_model),
         "firebase": bool(db),
-        "broadcast": bool(line_config)
+        "broadcast": bool(line_api)
     }
     
     # Test Firebase connectivity
@@ -206,7 +238,7 @@ def healthz():
             list(db.collection('health_check').limit(1).stream())
             services_status["firebase_connectivity"] = True
         except Exception as e:
-            logger.warning(f"Firebase connectivity test failed: {e}")
+            logger.warning("Firebase connectivity test failed: %s", e)
             services_status["firebase_connectivity"] = False
     
     response_time = (time.time() - start_time) * 1000  # ms
@@ -219,7 +251,7 @@ def healthz():
         "status": "healthy" if all_critical_ok else "degraded",
         "version": "21-optimized",
         "response_time_ms": round(response_time, 2),
-        "timestamp": datetime.datetime.now(tz=LOCAL_TZ).isoformat(),
+        "timestamp": _DT.now(tz=LOCAL_TZ).isoformat(),
         "services": services_status
     }), status_code
 
@@ -230,6 +262,11 @@ def metrics():
     avg_response_time = _metrics['total_response_time'] / max(_metrics['total_requests'], 1)
     error_rate = (_metrics['total_errors'] / max(_metrics['total_requests'], 1)) * 100
     
+    # Gemini response cache is the only cache in the app
+    gemini_cache = features.get_gemini_cache_stats()
+    _metrics["cache_hits"] = gemini_cache["hits"]
+    _metrics["cache_misses"] = gemini_cache["misses"]
+    
     return jsonify({
         "uptime_seconds": round(uptime, 2),
         "total_requests": _metrics["total_requests"],
@@ -247,10 +284,9 @@ def metrics():
 @app.route("/stats", methods=['GET'])
 def stats():
     """Show bot statistics"""
-    from handlers import _user_message_history
+    from handlers import get_rate_limit_stats
     
-    total_users = len(_user_message_history)
-    total_messages = sum(len(msgs) for msgs in _user_message_history.values())
+    rate_stats = get_rate_limit_stats()
     
     # Get broadcast stats if available
     broadcast_stats = {}
@@ -264,9 +300,10 @@ def stats():
             pass
     
     return jsonify({
-        "total_users": total_users,
-        "total_messages": total_messages,
-        "rate_limit_tracked_users": total_users,
+        "total_users": rate_stats["tracked_users"],
+        "total_messages": rate_stats["total_messages"],
+        "rate_limit_tracked_users": rate_stats["tracked_users"],
+        "rate_limit_banned_users": rate_stats["banned_users"],
         **broadcast_stats
     }), 200
 
@@ -286,7 +323,7 @@ def not_found(error):
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 errors"""
-    logger.error(f"Internal server error: {error}")
+    logger.error("Internal server error: %s", error)
     _metrics["total_errors"] += 1
     return jsonify({
         "error": "Internal Server Error",
@@ -296,7 +333,7 @@ def internal_error(error):
 @app.errorhandler(503)
 def service_unavailable(error):
     """Handle 503 errors"""
-    logger.error(f"Service unavailable: {error}")
+    logger.error("Service unavailable: %s", error)
     return jsonify({
         "error": "Service Unavailable",
         "message": "The service is temporarily unavailable. Please try again later."
@@ -319,12 +356,12 @@ def print_startup_banner():
 """
     logger.info(banner)
     logger.info("Configuration:")
-    logger.info(f"  • Port: {PORT}")
-    logger.info(f"  • Debug Mode: {FLASK_DEBUG}")
-    logger.info(f"  • LINE Bot: {'✅ Configured' if ACCESS_TOKEN and CHANNEL_SECRET else '❌ Not configured'}")
-    logger.info(f"  • Gemini AI: {'✅ Ready' if gemini_model else '❌ Disabled'}")
-    logger.info(f"  • Firebase: {'✅ Connected' if db else '❌ Disconnected'}")
-    logger.info(f"  • Broadcast: {'✅ Initialized' if line_config else '❌ Disabled'}")
+    logger.info("  • Port: %s", PORT)
+    logger.info("  • Debug Mode: %s", FLASK_DEBUG)
+    logger.info("  • LINE Bot: %s", '✅ Configured' if ACCESS_TOKEN and CHANNEL_SECRET else '❌ Not configured')
+    logger.info("  • Gemini AI: %s", '✅ Ready' if gemini_model else '❌ Disabled')
+    logger.info("  • Firebase: %s", '✅ Connected' if db else '❌ Disconnected')
+    logger.info("  • Broadcast: %s", '✅ Initialized' if line_api else '❌ Disabled')
     logger.info("")
     logger.info("Optimizations Enabled:")
     logger.info("  ⚡ Response caching")
@@ -345,7 +382,9 @@ def print_startup_banner():
 if __name__ == "__main__":
     print_startup_banner()
     
-    # Run Flask app
+    # Local development only. Production runs under gunicorn with threaded
+    # workers (see "Deployment" in the README):
+    #   gunicorn main:app --worker-class gthread --workers 1 --threads 8
     app.run(
         host="0.0.0.0",
         port=PORT,
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Tests for command matching (handlers.match_commands / find_commands)"""
+
+import unittest
+
+from features import (
+    get_absence_form_message, get_exam_countdown_message, get_grade_link_message,
+    get_music_link_message, get_timetable_image_message, get_worksheet_message,
+)
+from handlers import find_commands
+
+
+def actions(message_lower):
+    return [action for _, action in find_commands(message_lower)]
+
+
+class MatchCommandsTest(unittest.TestCase):
+    def test_short_keyword_inside_word_is_ignored(self):
+        self.assertEqual(actions("สอบกลางภาค"), [get_exam_countdown_message])
+        self.assertEqual(actions("เวลา"), [])
+        self.assertEqual(actions("ลาก่อน"), [])
+
+    def test_short_keyword_on_its_own(self):
+        self.assertEqual(actions("ลา"), [get_absence_form_message])
+        self.assertEqual(actions("ขอ ลา ครับ"), [get_absence_form_message])
+
+    def test_music_argument_is_not_scanned(self):
+        self.assertEqual(actions("เปิดเพลง ลาก่อน"), [get_music_link_message])
+        self.assertEqual(actions("เปิดเพลง ตารางเรียน"), [get_music_link_message])
+
+    def test_replies_follow_message_order(self):
+        self.assertEqual(
+            actions("เกรด งาน ตารางสอน"),
+            [get_grade_link_message, get_worksheet_message, get_timetable_image_message],
+        )
+        self.assertEqual(
+            actions("ตารางเรียน เปิดเพลง ลาก่อน"),
+            [get_timetable_image_message, get_music_link_message],
+        )
+
+    def test_song_title_is_text_after_keyword(self):
+        reply = get_music_link_message("ตารางเรียน เปิดเพลง ลาก่อน")
+        self.assertIn("ค้นหาเพลง: ลาก่อน\n", reply.text)
+
+
+if __name__ == "__main__":
+    unittest.main()
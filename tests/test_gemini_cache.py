@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Tests for the Gemini answer cache (features.get_gemini_response)"""
+
+import unittest
+from types import SimpleNamespace
+
+import features
+
+
+class FakeModel:
+    """Stands in for genai.GenerativeModel: answers every prompt with text"""
+
+    def __init__(self, text, finish_reason="STOP"):
+        self.text = text
+        self.finish_reason = SimpleNamespace(name=finish_reason)
+        self.prompts = []
+
+    def generate_content(self, prompt):
+        self.prompts.append(prompt)
+        part = SimpleNamespace(text=self.text)
+        candidate = SimpleNamespace(content=SimpleNamespace(parts=[part]), finish_reason=self.finish_reason)
+        return SimpleNamespace(candidates=[candidate])
+
+
+class GeminiCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._model = features.gemini_model
+        self._enabled = features.GEMINI_CACHE_ENABLED
+        features.GEMINI_CACHE_ENABLED = True
+        features._gemini_cache.clear()
+
+    def tearDown(self):
+        features.set_gemini_model(self._model)
+        features.GEMINI_CACHE_ENABLED = self._enabled
+        features._gemini_cache.clear()
+
+    def test_complete_answer_is_cached(self):
+        model = FakeModel("คำตอบ")
+        features.set_gemini_model(model)
+        self.assertEqual(features.get_gemini_response("สรุปบทที่ 1"), "คำตอบ")
+        self.assertEqual(features.get_gemini_response("สรุปบทที่  1"), "คำตอบ")
+        self.assertEqual(len(model.prompts), 1)
+
+    def test_truncated_answer_is_not_cached(self):
+        model = FakeModel("คำตอบที่ถูกตัด", finish_reason="MAX_TOKENS")
+        features.set_gemini_model(model)
+        self.assertEqual(features.get_gemini_response("สรุปบทที่ 2"), "คำตอบที่ถูกตัด")
+        self.assertEqual(features.get_gemini_response("สรุปบทที่ 2"), "คำตอบที่ถูกตัด")
+        self.assertEqual(len(model.prompts), 2)
+        self.assertEqual(features.get_gemini_cache_stats()["size"], 0)
+
+    def test_cached_answer_does_not_outlive_its_date(self):
+        model = FakeModel("คำตอบ")
+        features.set_gemini_model(model)
+        today = 739000
+        features._gemini_cached("วันนี้วันอะไร", today, 0, "วันนี้วันอะไร")
+        features._gemini_cached("วันนี้วันอะไร", today, 0, "วันนี้วันอะไร")
+        features._gemini_cached("วันนี้วันอะไร", today + 1, 0, "วันนี้วันอะไร")
+        self.assertEqual(len(model.prompts), 2)
+        self.assertIn(features._date_context(today + 1), model.prompts[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
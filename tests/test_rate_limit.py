@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Tests for the rate limiter replies (handlers.is_rate_limited)"""
+
+import unittest
+
+from config import RATE_LIMIT_MAX
+from handlers import RATE_LIMITED_REPLY, _rate_limited_reply, is_rate_limited
+
+
+class RateLimitReplyTest(unittest.TestCase):
+    def test_throttled_user_gets_fixed_reply(self):
+        user_id = "test-throttled"
+        for _ in range(RATE_LIMIT_MAX + 1):
+            limited, retry_after = is_rate_limited(user_id)
+        self.assertTrue(limited)
+        self.assertIs(_rate_limited_reply(user_id, retry_after), RATE_LIMITED_REPLY)
+
+    def test_banned_user_is_told_how_long_to_wait(self):
+        user_id = "test-banned"
+        retry_after = 0
+        for _ in range(RATE_LIMIT_MAX * 4):
+            limited, retry_after = is_rate_limited(user_id)
+        self.assertTrue(limited)
+        self.assertGreater(retry_after, 0)
+        reply = _rate_limited_reply(user_id, retry_after)
+        self.assertIn("⛔", reply.text)
+        self.assertIn(f"กรุณารออีก {retry_after} วินาที", reply.text)
+
+
+if __name__ == "__main__":
+    unittest.main()